@@ -12,15 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
 import gc
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Must be set before `huggingface_hub` is imported (also indirectly via gradio)
+os.environ.setdefault('HF_HUB_ENABLE_HF_TRANSFER', '1')
 
 import gradio as gr
 import pillow_avif
 import torch
 from huggingface_hub import snapshot_download
+from PIL import Image
 from pillow_heif import register_heif_opener
 
-from pipelines.pipeline_infu_flux import InfUFluxPipeline
+from pipelines.offload import CPU_OFFLOAD_CHOICES
+from pipelines.pipeline_infu_flux import InfUFluxPipeline, load_infu_models
+from pipelines.quantization import INFUSENET_QUANT_CHOICES, WEIGHT_QUANT_CHOICES, resolve_infusenet_quant
 
 
 # Register HEIF support for Pillow
@@ -34,79 +45,196 @@ class ModelVersion:
     
 ENABLE_ANTI_BLUR_DEFAULT = False
 ENABLE_REALISM_DEFAULT = False
+WEIGHT_QUANT_DEFAULT = 'bf16'
+CPU_OFFLOAD_DEFAULT = 'none'
+INFUSENET_QUANT_DEFAULT = 'follow'
+# Set `INFU_HARD_GC=1` to also release cached CUDA memory to the driver on every model reload
+HARD_GC = os.environ.get('INFU_HARD_GC', '0') == '1'
+# Set `INFU_TORCH_COMPILE=1` to compile Transformer and InfuseNet, which makes loading a model slower but inference faster.
+# The compiled graphs are captured as CUDA graphs, which require the weights to stay on GPU, i.e., no CPU offloading
+TORCH_COMPILE = os.environ.get('INFU_TORCH_COMPILE', '0') == '1'
+# Image sizes are snapped to multiples of the FLUX patch size x VAE downsampling factor
+SIZE_MULTIPLE = 16
+MIN_SIZE, MAX_SIZE = 512, 2048
+# Compiled graphs are specialized for static shapes, so sizes are snapped to a coarse grid to reuse them
+TORCH_COMPILE_SIZE_MULTIPLE = 64
+
+# Optional LoRAs are loaded once per pipeline and switched on/off via adapters
+OPTIONAL_LORAS = [
+    ['./models/InfiniteYou/supports/optional_loras/flux_realism_lora.safetensors', 'realism', 1.0],
+    ['./models/InfiniteYou/supports/optional_loras/flux_anti_blur_lora.safetensors', 'anti_blur', 1.0],
+]
+
+# Pipelines keyed by (model_version, weight_quant, resolved infusenet_quant), i.e., the options that require reloading weights.
+# The lock is also held while loading any model, including the prefetch
+loaded_pipelines = {}
+loaded_pipelines_lock = threading.Lock()
+# InfuseNet and image proj model of the other model version, loaded on CPU in the background, keyed as above
+prefetched_infu_models = {}
+prefetch_executor = ThreadPoolExecutor(max_workers=1)
+# ArcFace embeddings of the example ID images, keyed by a hash of the decoded image
+example_id_embeddings = {}
+
 
-loaded_pipeline_config = {
-    "model_version": "aes_stage2",
-    "enable_realism": False,
-    "enable_anti_blur": False,
-    'pipeline': None
-}
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cuda_device', default=0, type=int)
+    parser.add_argument('--server_name', default='localhost', help="""localhost | 0.0.0.0 (IPv4) | [::] (IPv6)""")
+    parser.add_argument('--server_port', default=7860, type=int)
+    parser.add_argument('--share', action='store_true', help="""whether to create a public Gradio share link""")
+    return parser.parse_args()
 
 
 def download_models():
-    snapshot_download(repo_id='ByteDance/InfiniteYou', local_dir='./models/InfiniteYou', local_dir_use_symlinks=False)
-    try:
-        snapshot_download(repo_id='black-forest-labs/FLUX.1-dev', local_dir='./models/FLUX.1-dev', local_dir_use_symlinks=False)
-    except Exception as e:
-        print(e)
-        print('\nYou are downloading `black-forest-labs/FLUX.1-dev` to `./models/FLUX.1-dev` but failed. '
-              'Please accept the agreement and obtain access at https://huggingface.co/black-forest-labs/FLUX.1-dev. '
-              'Then, use `huggingface-cli login` and your access tokens at https://huggingface.co/settings/tokens to authenticate. '
-              'After that, run the code again.')
-        print('\nYou can also download it manually from HuggingFace and put it in `./models/InfiniteYou`, '
-              'or you can modify `base_model_path` in `app.py` to specify the correct path.')
-        exit()
-
-
-def prepare_pipeline(model_version, enable_realism, enable_anti_blur):
-    if (
-        loaded_pipeline_config['pipeline'] is not None
-        and loaded_pipeline_config["enable_realism"] == enable_realism 
-        and loaded_pipeline_config["enable_anti_blur"] == enable_anti_blur
-        and model_version == loaded_pipeline_config["model_version"]
-    ):
-        return loaded_pipeline_config['pipeline']
-    
-    loaded_pipeline_config["enable_realism"] = enable_realism
-    loaded_pipeline_config["enable_anti_blur"] = enable_anti_blur
-    loaded_pipeline_config["model_version"] = model_version
-
-    pipeline = loaded_pipeline_config['pipeline']
-    if pipeline is None or pipeline.model_version != model_version:
-        print(f'Switching model to {model_version}')
-        del pipeline
-        del loaded_pipeline_config['pipeline']
-        gc.collect()
-        torch.cuda.empty_cache()
-
-        if model_version == 'aes_stage2':
-            model_path = f'./models/InfiniteYou/infu_flux_v1.0/aes_stage2'
-        elif model_version == 'sim_stage1':
-            model_path = f'./models/InfiniteYou/infu_flux_v1.0/sim_stage1'
+    downloads = [
+        ('ByteDance/InfiniteYou', './models/InfiniteYou', ['infu_flux_v1.0/*', 'supports/*']),
+        # Only the diffusers-format components are needed, skip the single-file checkpoints
+        ('black-forest-labs/FLUX.1-dev', './models/FLUX.1-dev', [
+            'model_index.json', 'scheduler/*', 'text_encoder/*', 'text_encoder_2/*',
+            'tokenizer/*', 'tokenizer_2/*', 'transformer/*', 'vae/*',
+        ]),
+    ]
+    with ThreadPoolExecutor(max_workers=len(downloads)) as executor:
+        infu_future, flux_future = [
+            executor.submit(snapshot_download, repo_id=repo_id, local_dir=local_dir, allow_patterns=allow_patterns, max_workers=8, etag_timeout=30)
+            for repo_id, local_dir, allow_patterns in downloads
+        ]
+        infu_future.result()
+        try:
+            flux_future.result()
+        except Exception as e:
+            print(e)
+            print('\nYou are downloading `black-forest-labs/FLUX.1-dev` to `./models/FLUX.1-dev` but failed. '
+                  'Please accept the agreement and obtain access at https://huggingface.co/black-forest-labs/FLUX.1-dev. '
+                  'Then, use `huggingface-cli login` and your access tokens at https://huggingface.co/settings/tokens to authenticate. '
+                  'After that, run the code again.')
+            print('\nYou can also download it manually from HuggingFace and put it in `./models/InfiniteYou`, '
+                  'or you can modify `base_model_path` in `app.py` to specify the correct path.')
+            exit()
+
+
+def get_model_path(model_version):
+    if model_version == 'aes_stage2':
+        return f'./models/InfiniteYou/infu_flux_v1.0/aes_stage2'
+    elif model_version == 'sim_stage1':
+        return f'./models/InfiniteYou/infu_flux_v1.0/sim_stage1'
+    else:
+        raise ValueError(f'Model version {model_version} not supported.')
+
+
+def prefetch_other_version(pipeline_key, infusenet_quant, image_proj_num_tokens):
+    # Both model versions share the FLUX base model, so only their InfuseNet and image proj model differ. No reference
+    # to the pipeline is taken, which would keep it (and its VRAM) alive after being replaced while this task is pending
+    model_version = ModelVersion.STAGE_1 if pipeline_key[0] == ModelVersion.STAGE_2 else ModelVersion.STAGE_2
+    prefetch_key = (model_version, *pipeline_key[1:])
+    # Load under the lock, as `from_pretrained` patches `nn.Module` for the whole process while loading, which would
+    # break any model built concurrently by `prepare_pipeline`. A request arriving meanwhile waits for the prefetch
+    with loaded_pipelines_lock:
+        if prefetch_key in prefetched_infu_models or pipeline_key not in loaded_pipelines:
+            return
+        try:
+            print(f'Prefetching model {model_version}')
+            infu_models = load_infu_models(get_model_path(model_version), infusenet_quant, image_proj_num_tokens)
+        except Exception as e:
+            print(f'Failed to prefetch model {model_version}: {e}')
+            return
+        prefetched_infu_models.clear()
+        prefetched_infu_models[prefetch_key] = infu_models
+
+
+def prepare_pipeline(model_version, enable_realism, enable_anti_blur, weight_quant, cpu_offload, infusenet_quant):
+    if TORCH_COMPILE and cpu_offload != 'none':
+        raise ValueError('CPU offloading is not supported with `INFU_TORCH_COMPILE=1`.')
+    # Gradio runs handlers in worker threads, where the current CUDA device is not inherited
+    with loaded_pipelines_lock, torch.cuda.device(DEVICE):
+        pipeline_key = (model_version, weight_quant, resolve_infusenet_quant(infusenet_quant, weight_quant))
+        pipeline = loaded_pipelines.get(pipeline_key)
+        prefetched = prefetched_infu_models.pop(pipeline_key, None)
+        if pipeline is None and prefetched is not None:
+            print(f'Switching model to {model_version} (prefetched)')
+            (_, pipeline), = loaded_pipelines.items()
+            loaded_pipelines.clear()
+            loaded_pipelines[pipeline_key] = pipeline
+            pipeline.switch_model_version(model_version, *prefetched)
+            pipeline.set_cpu_offload(cpu_offload)
+            pipeline.warmed_up = False
+        elif pipeline is None:
+            print(f'Switching model to {model_version}')
+            # Only one pipeline fits in memory, release the previous one before loading
+            loaded_pipelines.clear()
+            prefetched_infu_models.clear()
+            # Quantized, compiled or streamed models are kept in reference cycles, which only the garbage collector frees
+            gc.collect()
+            if HARD_GC:
+                torch.cuda.empty_cache()
+
+            model_path = get_model_path(model_version)
+            print(f'Loading model from {model_path}')
+
+            pipeline = InfUFluxPipeline(
+                base_model_path='./models/FLUX.1-dev',
+                infu_model_path=model_path,
+                insightface_root_path='./models/InfiniteYou/supports/insightface',
+                image_proj_num_tokens=8,
+                infu_flux_version='v1.0',
+                model_version=model_version,
+                weight_quant=weight_quant,
+                cpu_offload=cpu_offload,
+                infusenet_quant=infusenet_quant,
+            )
+            pipeline.load_loras(OPTIONAL_LORAS)
+            pipeline.last_loras = None
+            pipeline.warmed_up = False
+
+            loaded_pipelines[pipeline_key] = pipeline
         else:
-            raise ValueError(f'Model version {model_version} not supported.')
-        print(f'Loading model from {model_path}')
-
-        pipeline = InfUFluxPipeline(
-            base_model_path='./models/FLUX.1-dev',
-            infu_model_path=model_path,
-            insightface_root_path='./models/InfiniteYou/supports/insightface',
-            image_proj_num_tokens=8,
-            infu_flux_version='v1.0',
-            model_version=model_version,
-        )
+            pipeline.set_cpu_offload(cpu_offload)
+
+        enabled_loras = {'realism': enable_realism, 'anti_blur': enable_anti_blur}
+        loras = [(lora_name, lora_scale) for _, lora_name, lora_scale in OPTIONAL_LORAS if enabled_loras[lora_name]]
+        # Fusing removes the LoRA overhead at every step. It is only done for bf16 weights, as merging into quantized
+        # weights is not supported. Layer-wise streaming keeps its own copies of the weights, so it is skipped there too.
+        # Toggling offloading unfuses the LoRAs (see `set_cpu_offload`), which are then fused again here if possible
+        fuse_loras = len(loras) > 0 and pipeline.weight_quant == 'bf16' and pipeline.cpu_offload != 'layer-stream'
+        lora_fused = len(pipeline.fused_lora_layers) > 0
+        if loras != pipeline.last_loras or fuse_loras != lora_fused:
+            pipeline.unfuse_loras()
+            if len(loras) > 0:
+                lora_names = [lora_name for lora_name, _ in loras]
+                pipeline.pipe.enable_lora()
+                pipeline.pipe.set_adapters(lora_names, adapter_weights=[lora_scale for _, lora_scale in loras])
+                if fuse_loras:
+                    pipeline.fuse_loras(lora_names)
+            else:
+                pipeline.pipe.disable_lora()
+            pipeline.last_loras = loras
+
+        if TORCH_COMPILE and not pipeline.warmed_up:
+            warmup_pipeline(pipeline)
 
-        loaded_pipeline_config['pipeline'] = pipeline
+    return pipeline
 
-    pipeline.pipe.delete_adapters(['realism', 'anti_blur'])
-    loras = []
-    if enable_realism:
-        loras.append(['./models/InfiniteYou/supports/optional_loras/flux_realism_lora.safetensors', 'realism', 1.0])
-    if enable_anti_blur:
-        loras.append(['./models/InfiniteYou/supports/optional_loras/flux_anti_blur_lora.safetensors', 'anti_blur', 1.0])
-    pipeline.load_loras(loras)
 
-    return pipeline
+def warmup_pipeline(pipeline):
+    print('Compiling and warming up the pipeline')
+    for model in (pipeline.pipe.transformer, pipeline.pipe.controlnet):
+        # After a model version switch, only the new InfuseNet has to be compiled
+        if model._compiled_call_impl is None:
+            model.compile(mode='reduce-overhead', dynamic=False)
+    pipeline(
+        id_image=Image.open('./assets/examples/man.jpg').convert('RGB'),
+        prompt='',
+        width=snap_size(864, TORCH_COMPILE_SIZE_MULTIPLE),
+        height=snap_size(1152, TORCH_COMPILE_SIZE_MULTIPLE),
+        num_steps=1,
+    )
+    pipeline.warmed_up = True
+
+
+def snap_size(size, multiple):
+    # Clamp, then round down to a multiple
+    size = min(max(int(size), MIN_SIZE), MAX_SIZE)
+    return size // multiple * multiple
 
 
 def generate_image(
@@ -123,37 +251,72 @@ def generate_image(
     infusenet_guidance_end,
     enable_realism,
     enable_anti_blur,
-    model_version
+    model_version,
+    weight_quant=WEIGHT_QUANT_DEFAULT,
+    cpu_offload=CPU_OFFLOAD_DEFAULT,
+    infusenet_quant=INFUSENET_QUANT_DEFAULT,
+    cache_id_embedding=False,
 ):
-    pipeline = prepare_pipeline(model_version=model_version, enable_realism=enable_realism, enable_anti_blur=enable_anti_blur)
-
-    if seed == 0:
-        seed = torch.seed() & 0xFFFFFFFF
-
     try:
-        image = pipeline(
-            id_image=input_image,
-            prompt=prompt,
-            control_image=control_image,
-            seed=seed,
-            width=width,
-            height=height,
-            guidance_scale=guidance_scale,
-            num_steps=num_steps,
-            infusenet_conditioning_scale=infusenet_conditioning_scale,
-            infusenet_guidance_start=infusenet_guidance_start,
-            infusenet_guidance_end=infusenet_guidance_end,
+        # e.g., a cleared `gr.Number` field is passed as None and rejected here
+        seed = int(seed)
+        if seed == 0:
+            # The seed is shown to and re-entered by the user via `gr.Number`, i.e., a float, keep it exactly representable
+            seed = int(torch.empty((), dtype=torch.int64).random_().item()) & ((1 << 53) - 1)
+
+        size_multiple = TORCH_COMPILE_SIZE_MULTIPLE if TORCH_COMPILE else SIZE_MULTIPLE
+        width = snap_size(width, size_multiple)
+        height = snap_size(height, size_multiple)
+
+        # e.g., layer-wise streaming offloading with quantized weights is rejected here
+        pipeline = prepare_pipeline(
+            model_version=model_version,
+            enable_realism=enable_realism,
+            enable_anti_blur=enable_anti_blur,
+            weight_quant=weight_quant,
+            cpu_offload=cpu_offload,
+            infusenet_quant=infusenet_quant,
         )
+        with torch.cuda.device(DEVICE):
+            id_embedding = get_example_id_embedding(pipeline, input_image) if cache_id_embedding else None
+            image = pipeline(
+                id_image=input_image,
+                prompt=prompt,
+                control_image=control_image,
+                seed=seed,
+                generator=torch.Generator(device=DEVICE).manual_seed(seed),
+                width=width,
+                height=height,
+                guidance_scale=guidance_scale,
+                num_steps=num_steps,
+                infusenet_conditioning_scale=infusenet_conditioning_scale,
+                infusenet_guidance_start=infusenet_guidance_start,
+                infusenet_guidance_end=infusenet_guidance_end,
+                id_embedding=id_embedding,
+            )
     except Exception as e:
         print(e)
         gr.Error(f"An error occurred: {e}")
-        return gr.update()
+        return gr.update(), gr.update(), gr.update()
 
-    return gr.update(value = image, label=f"Generated Image, seed = {seed}")
+    # Hide the cost of switching model versions by prefetching the other one while the GPU is idle
+    pipeline_key = (model_version, weight_quant, pipeline.infusenet_quant)
+    prefetch_executor.submit(prefetch_other_version, pipeline_key, pipeline.infusenet_quant, pipeline.image_proj_num_tokens)
+
+    # Also reflect the snapped size back to the UI
+    return gr.update(value = image, label=f"Generated Image, seed = {seed}"), width, height
+
+
+def get_example_id_embedding(pipeline, id_image):
+    # Examples are passed as decoded images, so they are identified by their content rather than their path
+    key = hashlib.sha1(f'{id_image.mode}{id_image.size}'.encode() + id_image.tobytes()).hexdigest()
+    if key not in example_id_embeddings:
+        example_id_embeddings[key] = pipeline.extract_id_embedding(id_image)
+    return example_id_embeddings[key]
 
 
 def generate_examples(id_image, control_image, prompt_text, seed, enable_realism, enable_anti_blur, model_version):
-    return generate_image(id_image, control_image, prompt_text, seed, 864, 1152, 3.5, 30, 1.0, 0.0, 1.0, enable_realism, enable_anti_blur, model_version)
+    return generate_image(id_image, control_image, prompt_text, seed, 864, 1152, 3.5, 30, 1.0, 0.0, 1.0, enable_realism, enable_anti_blur, model_version, cache_id_embedding=True)[0]
 
 
 sample_list = [
@@ -225,6 +388,15 @@ with gr.Blocks() as demo:
                     ui_enable_realism = gr.Checkbox(label="Enable realism LoRA", value=ENABLE_REALISM_DEFAULT)
                     ui_enable_anti_blur = gr.Checkbox(label="Enable anti-blur LoRA", value=ENABLE_ANTI_BLUR_DEFAULT)
 
+            with gr.Accordion("Memory Reduction [Optional]", open=False):
+                ui_weight_quant = gr.Dropdown(label="Weight quantization (Transformer and T5)", choices=WEIGHT_QUANT_CHOICES, value=WEIGHT_QUANT_DEFAULT)
+                ui_cpu_offload = gr.Dropdown(label="CPU offloading", choices=CPU_OFFLOAD_CHOICES, value=CPU_OFFLOAD_DEFAULT)
+                ui_infusenet_quant = gr.Dropdown(
+                    label="InfuseNet quantization (overrides weight quantization for InfuseNet)",
+                    choices=INFUSENET_QUANT_CHOICES,
+                    value=INFUSENET_QUANT_DEFAULT,
+                )
+
         with gr.Column(scale=2):
             image_output = gr.Image(label="Generated Image", interactive=False, height=550, format='png')
             gr.Markdown(
@@ -233,6 +405,7 @@ with gr.Blocks() as demo:
                 - **Model Version**: `aes_stage2` is used by default for better text-image alignment and aesthetics. For higher ID similarity, try `sim_stage1`.
                 - **Useful Hyperparameters**: Usually, there is NO need to adjust too much. If necessary, try a slightly larger `--infusenet_guidance_start` (*e.g.*, `0.1`) only (especially helpful for `sim_stage1`). If still not satisfactory, then try a slightly smaller `--infusenet_conditioning_scale` (*e.g.*, `0.9`).
                 - **Optional LoRAs**: `realism` and `anti-blur`. To enable them, please check the corresponding boxes. If needed, try `realism` only first. They are optional and were NOT used in our paper.
+                - **Memory Reduction**: If the GPU memory is insufficient, try `weight quantization` (*e.g.*, `int8` or `nf4`) and/or `CPU offloading`. `int8_blockwise` saves as much memory as `int8` but is slower than `bf16`, as its weights are dequantized at every step. The `layer-stream` offloading overlaps weight transfers with compute but only supports `bf16` and `int8_blockwise` weights. Toggling `CPU offloading` or LoRAs does NOT reload the model.
                 - **Gender Prompt**: If the generated gender is not preferred, add specific words in the prompt, such as 'a man', 'a woman', *etc*. We encourage using inclusive and respectful language.
                 """
             )
@@ -261,9 +434,12 @@ with gr.Blocks() as demo:
             ui_infusenet_guidance_end,
             ui_enable_realism,
             ui_enable_anti_blur,
-            ui_model_version
+            ui_model_version,
+            ui_weight_quant,
+            ui_cpu_offload,
+            ui_infusenet_quant,
         ], 
-        outputs=[image_output], 
+        outputs=[image_output, ui_width, ui_height], 
         concurrency_id="gpu"
     )
 
@@ -307,11 +483,23 @@ with gr.Blocks() as demo:
         """
     )
 
-download_models()
+args = parse_args()
+
+# Set cuda device
+DEVICE = torch.device(f'cuda:{args.cuda_device}')
+torch.cuda.set_device(DEVICE)
 
-prepare_pipeline(model_version=ModelVersion.DEFAULT_VERSION, enable_realism=ENABLE_REALISM_DEFAULT, enable_anti_blur=ENABLE_ANTI_BLUR_DEFAULT)
+download_models()
 
-demo.queue()
-demo.launch(server_name='localhost')  # localhost
-# demo.launch(server_name='0.0.0.0')  # IPv4
-# demo.launch(server_name='[::]')  # IPv6
+prepare_pipeline(
+    model_version=ModelVersion.DEFAULT_VERSION,
+    enable_realism=ENABLE_REALISM_DEFAULT,
+    enable_anti_blur=ENABLE_ANTI_BLUR_DEFAULT,
+    weight_quant=WEIGHT_QUANT_DEFAULT,
+    cpu_offload=CPU_OFFLOAD_DEFAULT,
+    infusenet_quant=INFUSENET_QUANT_DEFAULT,
+)
+
+# Only one generation runs at a time on the GPU, cached examples are served without the GPU
+demo.queue(default_concurrency_limit=1, max_size=32)
+demo.launch(server_name=args.server_name, server_port=args.server_port, share=args.share, show_api=False)
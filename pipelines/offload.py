@@ -0,0 +1,122 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import itertools
+
+import torch
+import torch.nn as nn
+
+
+CPU_OFFLOAD_CHOICES = ['none', 'model', 'layer-stream']
+
+
+def get_cpu_offload_mode(cpu_offload):
+    """Normalize a CPU offloading option, booleans map to `none` | `model`."""
+    if isinstance(cpu_offload, bool):
+        return 'model' if cpu_offload else 'none'
+    if cpu_offload not in CPU_OFFLOAD_CHOICES:
+        raise ValueError(f'CPU offloading mode {cpu_offload} not supported.')
+    return cpu_offload
+
+
+class LayerStreamOffloader:
+    """Stream the transformer blocks of a model between CPU and GPU during forward.
+
+    Block weights are kept in pinned CPU memory. While block `i` is computed, the weights of
+    block `i + 1` are copied to the GPU on a side stream, so the transfers overlap with the
+    compute. The weights are not modified during inference, so offloading a block only drops
+    its GPU copy. All the other (small) submodules stay on the GPU.
+
+    Args:
+        model (nn.Module): Model containing the blocks, e.g., the FLUX transformer or InfuseNet.
+        block_names (tuple[str]): Names of the `nn.ModuleList` children to be streamed.
+        device (str or torch.device): The device to run the blocks on.
+    """
+
+    def __init__(self, model, block_names=('transformer_blocks', 'single_transformer_blocks'), device='cuda'):
+        self.check_model(model, block_names)
+        self.device = torch.device(device)
+        self.blocks = []
+        for name, child in model.named_children():
+            if name in block_names:
+                self.blocks.extend(child)
+            elif child is not None:
+                child.to(self.device)
+
+        self.cpu_tensors = {}  # id(tensor) -> (tensor, pinned CPU data)
+        for block in self.blocks:
+            self._offload(block)
+
+        self.stream = torch.cuda.Stream(self.device)
+        self.events = {}  # index of the block -> event recorded after its weights are copied
+        self.handles = []
+        for index, block in enumerate(self.blocks):
+            self.handles.append(block.register_forward_pre_hook(functools.partial(self._pre_forward, index)))
+            self.handles.append(block.register_forward_hook(functools.partial(self._post_forward, index)))
+
+    @staticmethod
+    def check_model(model, block_names=('transformer_blocks', 'single_transformer_blocks')):
+        """Raise a `ValueError` if the blocks of a model cannot be streamed, without modifying the model."""
+        for name, child in model.named_children():
+            if name not in block_names:
+                continue
+            for param in child.parameters():
+                if type(param) is not nn.Parameter or type(param.data) is not torch.Tensor:
+                    raise ValueError('Layer-wise streaming offloading does not support quantized weights.')
+
+    def _block_tensors(self, block):
+        return itertools.chain(block.parameters(), block.buffers())
+
+    def _cpu_data(self, tensor):
+        # Tensors added after construction (e.g., LoRA weights) are pinned on first use
+        if id(tensor) not in self.cpu_tensors:
+            self.cpu_tensors[id(tensor)] = (tensor, tensor.data.cpu().pin_memory())
+        return self.cpu_tensors[id(tensor)][1]
+
+    def _offload(self, block):
+        for tensor in self._block_tensors(block):
+            tensor.data = self._cpu_data(tensor)
+
+    def _prefetch(self, index):
+        if index in self.events:
+            return
+        with torch.cuda.stream(self.stream):
+            for tensor in self._block_tensors(self.blocks[index]):
+                tensor.data = self._cpu_data(tensor).to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.events[index] = event
+
+    def _pre_forward(self, index, module, args):
+        self._prefetch(index)
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(self.events[index])
+        for tensor in self._block_tensors(module):
+            tensor.data.record_stream(compute_stream)
+        # Wrap around so that the first block is ready for the next denoising step
+        self._prefetch((index + 1) % len(self.blocks))
+
+    def _post_forward(self, index, module, args, output):
+        self._offload(module)
+        self.events.pop(index, None)
+
+    def remove(self):
+        """Remove the hooks and leave all block weights on CPU."""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        for block in self.blocks:
+            self._offload(block)
+        self.events.clear()
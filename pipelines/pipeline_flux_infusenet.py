@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import inspect
+from collections import OrderedDict
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -23,6 +24,7 @@ from diffusers.models.controlnet_flux import FluxControlNetModel, FluxMultiContr
 from diffusers.image_processor import PipelineImageInput
 from diffusers.pipelines.flux.pipeline_output import FluxPipelineOutput
 from diffusers.utils import replace_example_docstring, is_torch_xla_available, logging
+from peft.tuners.tuners_utils import BaseTunerLayer
 
 
 if is_torch_xla_available():
@@ -110,6 +112,35 @@ def retrieve_timesteps(
 
 
 class FluxInfuseNetPipeline(FluxControlNetPipeline):
+    # Text embeddings of the most recent prompts, reused across calls since they do not depend on the inputs
+    prompt_embeds_cache_size = 4
+    _prompt_embeds_cache = None
+
+    def _prompt_embeds_cache_key(self, prompt, prompt_2, device, num_images_per_prompt, max_sequence_length, lora_scale):
+        # Embeddings are not cached if LoRAs are applied to the text encoders, as they can be toggled between calls
+        text_encoders = [text_encoder for text_encoder in (self.text_encoder, self.text_encoder_2) if text_encoder is not None]
+        if prompt is None or any(isinstance(module, BaseTunerLayer) for text_encoder in text_encoders for module in text_encoder.modules()):
+            return None
+        prompt = tuple(prompt) if isinstance(prompt, list) else prompt
+        prompt_2 = tuple(prompt_2) if isinstance(prompt_2, list) else prompt_2
+        return (prompt, prompt_2, str(torch.device(device)), num_images_per_prompt, max_sequence_length, lora_scale)
+
+    def _is_prompt_embeds_cached(self, cache_key):
+        return cache_key is not None and self._prompt_embeds_cache is not None and cache_key in self._prompt_embeds_cache
+
+    def _encode_prompt_cached(self, cache_key, **kwargs):
+        if self._prompt_embeds_cache is None:
+            self._prompt_embeds_cache = OrderedDict()
+        if self._is_prompt_embeds_cached(cache_key):
+            self._prompt_embeds_cache.move_to_end(cache_key)
+            return self._prompt_embeds_cache[cache_key]
+        outputs = self.encode_prompt(**kwargs)
+        if cache_key is not None:
+            self._prompt_embeds_cache[cache_key] = outputs
+            while len(self._prompt_embeds_cache) > self.prompt_embeds_cache_size:
+                self._prompt_embeds_cache.popitem(last=False)
+        return outputs
+
     @torch.no_grad()
     def __call__(
         self,
@@ -309,6 +340,25 @@ class FluxInfuseNetPipeline(FluxControlNetPipeline):
         device = self._execution_device if not cpu_offload else 'cuda'
         dtype = self.transformer.dtype
 
+        lora_scale = (
+            self.joint_attention_kwargs.get("scale", None) if self.joint_attention_kwargs is not None else None
+        )
+        prompt_cache_key = None
+        if prompt_embeds is None:
+            prompt_cache_key = self._prompt_embeds_cache_key(
+                prompt, prompt_2, device, num_images_per_prompt, max_sequence_length, lora_scale
+            )
+        negative_prompt_cache_key = None
+        if negative_prompt_embeds is None:
+            negative_prompt_cache_key = self._prompt_embeds_cache_key(
+                negative_prompt, negative_prompt_2, device, num_images_per_prompt, max_sequence_length, lora_scale
+            )
+        # The text encoders are not needed if all the embeddings are given or cached
+        need_text_encoders = (
+            (prompt_embeds is None and not self._is_prompt_embeds_cached(prompt_cache_key))
+            or (negative_prompt is not None and negative_prompt_embeds is None and not self._is_prompt_embeds_cached(negative_prompt_cache_key))
+        )
+
         if cpu_offload:
             # Move VAE, Transformer, InfuseNet to CPU
             self.vae.cpu()
@@ -316,18 +366,17 @@ class FluxInfuseNetPipeline(FluxControlNetPipeline):
             self.controlnet.cpu()
             torch.cuda.empty_cache()
 
-            # Move CLIP and T5 to GPU
-            self.text_encoder.to(device)
-            self.text_encoder_2.to(device)
+            if need_text_encoders:
+                # Move CLIP and T5 to GPU
+                self.text_encoder.to(device)
+                self.text_encoder_2.to(device)
 
-        lora_scale = (
-            self.joint_attention_kwargs.get("scale", None) if self.joint_attention_kwargs is not None else None
-        )
         (
             prompt_embeds,
             pooled_prompt_embeds,
             text_ids,
-        ) = self.encode_prompt(
+        ) = self._encode_prompt_cached(
+            prompt_cache_key,
             prompt=prompt,
             prompt_2=prompt_2,
             prompt_embeds=prompt_embeds,
@@ -342,7 +391,8 @@ class FluxInfuseNetPipeline(FluxControlNetPipeline):
                 negative_prompt_embeds,
                 negative_pooled_prompt_embeds,
                 negative_text_ids,
-            ) = self.encode_prompt(
+            ) = self._encode_prompt_cached(
+                negative_prompt_cache_key,
                 prompt=negative_prompt,
                 prompt_2=negative_prompt_2,
                 prompt_embeds=negative_prompt_embeds,
@@ -398,7 +448,7 @@ class FluxInfuseNetPipeline(FluxControlNetPipeline):
             controlnet_blocks_repeat = False if self.controlnet.input_hint_block is None else True
             if self.controlnet.input_hint_block is None:
                 # vae encode
-                control_image = self.vae.encode(control_image).latent_dist.sample()
+                control_image = self.vae.encode(control_image).latent_dist.sample(generator=generator)
                 control_image = (control_image - self.vae.config.shift_factor) * self.vae.config.scaling_factor
 
                 # pack
@@ -436,7 +486,7 @@ class FluxInfuseNetPipeline(FluxControlNetPipeline):
 
                 if self.controlnet.nets[0].input_hint_block is None:
                     # vae encode
-                    control_image_ = self.vae.encode(control_image_).latent_dist.sample()
+                    control_image_ = self.vae.encode(control_image_).latent_dist.sample(generator=generator)
                     control_image_ = (control_image_ - self.vae.config.shift_factor) * self.vae.config.scaling_factor
 
                     # pack
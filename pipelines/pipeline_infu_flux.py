@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gc
+import json
 import math
 import os
 import random
@@ -21,15 +23,19 @@ import cv2
 import numpy as np
 import torch
 from diffusers import FluxControlNetModel, FluxTransformer2DModel
+from diffusers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFETENSORS_WEIGHTS_NAME
 from facexlib.recognition import init_recognition_model
 from huggingface_hub import snapshot_download
 from insightface.app import FaceAnalysis
 from insightface.utils import face_align
+from peft.tuners.lora import LoraLayer
 from PIL import Image
-from optimum.quanto import freeze, qint8, quantize
+from safetensors import safe_open
 from transformers import T5EncoderModel
 
+from .offload import LayerStreamOffloader, get_cpu_offload_mode
 from .pipeline_flux_infusenet import FluxInfuseNetPipeline
+from .quantization import quantize_model, resolve_infusenet_quant
 from .resampler import Resampler
 
 
@@ -44,7 +50,7 @@ def seed_everything(seed, deterministic=False):
             Default: False.
     """
     random.seed(seed)
-    np.random.seed(seed)
+    np.random.seed(seed & 0xFFFFFFFF)  # NumPy only accepts 32-bit seeds
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
@@ -89,7 +95,7 @@ def extract_arcface_bgr_embedding(in_image, landmark, arcface_model=None, in_set
     arc_face_image = face_align.norm_crop(in_image, landmark=np.array(kps), image_size=112)
     arc_face_image = torch.from_numpy(arc_face_image).unsqueeze(0).permute(0,3,1,2) / 255.
     arc_face_image = 2 * arc_face_image - 1
-    arc_face_image = arc_face_image.cuda().contiguous()
+    arc_face_image = arc_face_image.contiguous().pin_memory().cuda(non_blocking=True)
     if arcface_model is None:
         arcface_model = init_recognition_model('arcface', device='cuda')
     face_emb = arcface_model(arc_face_image)[0] # [512], normalized
@@ -123,6 +129,50 @@ def resize_and_pad_image(source_img, target_img_size):
     return padded_img
 
 
+def to_pinned_tensor(image_pil, size_multiple=16, device='cuda'):
+    # Same as the pipeline's `image_processor.preprocess` with `vae_scale_factor=size_multiple`, i.e., rounding the size
+    # down to multiples of `size_multiple`, but the copy to GPU goes through pinned memory and does not block
+    width, height = image_pil.size
+    if width % size_multiple != 0 or height % size_multiple != 0:
+        image_pil = image_pil.resize((width - width % size_multiple, height - height % size_multiple), Image.LANCZOS)
+    image = torch.from_numpy(np.array(image_pil.convert('RGB'))).pin_memory()
+    image = image.to(device, non_blocking=True)
+    image = image.permute(2, 0, 1).unsqueeze(0).float() / 127.5 - 1.0  # [1, 3, H, W] in [-1, 1]
+    return image
+
+
+def load_infusenet(infu_model_path, infusenet_quant='bf16'):
+    infusenet_path = os.path.join(infu_model_path, 'InfuseNetModel')
+    infusenet = FluxControlNetModel.from_pretrained(infusenet_path, torch_dtype=torch.bfloat16)
+    quantize_model(infusenet, infusenet_quant)
+    return infusenet
+
+
+def load_image_proj_model(infu_model_path, image_proj_num_tokens=8):
+    image_proj_model = Resampler(
+        dim=1280,
+        depth=4,
+        dim_head=64,
+        heads=20,
+        num_queries=image_proj_num_tokens,
+        embedding_dim=512,
+        output_dim=4096,
+        ff_mult=4,
+    )
+    image_proj_model_path = os.path.join(infu_model_path, 'image_proj_model.bin')
+    ipm_state_dict = torch.load(image_proj_model_path, map_location="cpu", weights_only=True)
+    image_proj_model.load_state_dict(ipm_state_dict['image_proj'])
+    del ipm_state_dict
+    image_proj_model.to(torch.bfloat16)
+    image_proj_model.eval()
+    return image_proj_model
+
+
+def load_infu_models(infu_model_path, infusenet_quant='bf16', image_proj_num_tokens=8):
+    # The model-version-specific parts of the pipeline, loaded on CPU
+    return load_infusenet(infu_model_path, infusenet_quant), load_image_proj_model(infu_model_path, image_proj_num_tokens)
+
+
 class InfUFluxPipeline:
     def __init__(
             self, 
@@ -132,35 +182,35 @@ class InfUFluxPipeline:
             image_proj_num_tokens=8,
             infu_flux_version='v1.0',
             model_version='aes_stage2',
-            quantize_8bit=False,
-            cpu_offload=False,
+            quantize_8bit=False,  # same as `weight_quant='int8'`, kept for compatibility
+            cpu_offload=False,  # none | model | layer-stream, or bool (True for model)
+            infusenet_quant=None,  # follow | bf16 | nf4 | int8 | int4 | fp8 | int8_blockwise, follows `weight_quant` if not set
+            weight_quant=None,  # bf16 | int8 | int8_blockwise | nf4 for Transformer and T5, follows `quantize_8bit` if not set
         ):
 
         self.infu_flux_version = infu_flux_version
         self.model_version = model_version
+        if weight_quant is None:
+            weight_quant = 'int8' if quantize_8bit else 'bf16'
+        self.weight_quant = weight_quant
+        infusenet_quant = resolve_infusenet_quant(infusenet_quant, weight_quant)
+        self.infusenet_quant = infusenet_quant
+        self.image_proj_num_tokens = image_proj_num_tokens
         
         # Load pipeline
         try:
-            infusenet_path = os.path.join(infu_model_path, 'InfuseNetModel')
-            self.infusenet = FluxControlNetModel.from_pretrained(infusenet_path, torch_dtype=torch.bfloat16)
+            self.infusenet = load_infusenet(infu_model_path, infusenet_quant)
         except:
             print("No InfiniteYou model found. Downloading from HuggingFace `ByteDance/InfiniteYou` to `./models/InfiniteYou` ...")
             snapshot_download(repo_id='ByteDance/InfiniteYou', local_dir='./models/InfiniteYou', local_dir_use_symlinks=False)
             infu_model_path = os.path.join('./models/InfiniteYou', f'infu_flux_{infu_flux_version}', model_version)
-            infusenet_path = os.path.join(infu_model_path, 'InfuseNetModel')
-            self.infusenet = FluxControlNetModel.from_pretrained(infusenet_path, torch_dtype=torch.bfloat16)
+            self.infusenet = load_infusenet(infu_model_path, infusenet_quant)
             insightface_root_path = './models/InfiniteYou/supports/insightface'
-        if quantize_8bit:
-            quantize(self.infusenet, weights=qint8)
-            freeze(self.infusenet)
         try:
             transformer = FluxTransformer2DModel.from_pretrained(base_model_path, subfolder="transformer", torch_dtype=torch.bfloat16)
             text_encoder_2 = T5EncoderModel.from_pretrained(base_model_path, subfolder="text_encoder_2", torch_dtype=torch.bfloat16)
-            if quantize_8bit:
-                quantize(transformer, weights=qint8)
-                freeze(transformer)
-                quantize(text_encoder_2, weights=qint8)
-                freeze(text_encoder_2)
+            quantize_model(transformer, weight_quant)
+            quantize_model(text_encoder_2, weight_quant)
             pipe = FluxInfuseNetPipeline.from_pretrained(
                 base_model_path,
                 transformer=transformer,
@@ -176,44 +226,30 @@ class InfUFluxPipeline:
                     'After that, run the code again. If you have downloaded it, please use `base_model_path` to specify the correct path.')
             print('\nIf you are using other models, please download them to a local directory and use `base_model_path` to specify the correct path.')
             exit()
-        if not cpu_offload:
-            pipe.to('cuda')
         self.pipe = pipe
+        self.base_model_path = base_model_path
+        self.fused_lora_layers = []  # names of the Transformer LoRA layers fused into their base layers
+        self.cpu_offload = 'model'  # all models are still on CPU
+        self.layer_stream_offloaders = {}
+        self.set_cpu_offload(cpu_offload)
 
         # Load image proj model
-        num_tokens = image_proj_num_tokens
-        image_emb_dim = 512
-        image_proj_model = Resampler(
-            dim=1280,
-            depth=4,
-            dim_head=64,
-            heads=20,
-            num_queries=num_tokens,
-            embedding_dim=image_emb_dim,
-            output_dim=4096,
-            ff_mult=4,
-        )
-        image_proj_model_path = os.path.join(infu_model_path, 'image_proj_model.bin')
-        ipm_state_dict = torch.load(image_proj_model_path, map_location="cpu", weights_only=True)
-        image_proj_model.load_state_dict(ipm_state_dict['image_proj'])
-        del ipm_state_dict
-        image_proj_model.to('cuda', torch.bfloat16)
-        image_proj_model.eval()
-
-        self.image_proj_model = image_proj_model
-
-        # Load face encoder
+        self.image_proj_model = load_image_proj_model(infu_model_path, image_proj_num_tokens).to('cuda')
+
+        # Load face encoder on the current cuda device, ONNX Runtime would use device 0 otherwise
+        device_id = torch.cuda.current_device()
+        providers = [('CUDAExecutionProvider', {'device_id': device_id}), 'CPUExecutionProvider']
         self.app_640 = FaceAnalysis(name='antelopev2', 
-                                root=insightface_root_path, providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-        self.app_640.prepare(ctx_id=0, det_size=(640, 640))
+                                root=insightface_root_path, providers=providers)
+        self.app_640.prepare(ctx_id=device_id, det_size=(640, 640))
 
         self.app_320 = FaceAnalysis(name='antelopev2', 
-                                root=insightface_root_path, providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-        self.app_320.prepare(ctx_id=0, det_size=(320, 320))
+                                root=insightface_root_path, providers=providers)
+        self.app_320.prepare(ctx_id=device_id, det_size=(320, 320))
 
         self.app_160 = FaceAnalysis(name='antelopev2', 
-                                root=insightface_root_path, providers=['CUDAExecutionProvider', 'CPUExecutionProvider'])
-        self.app_160.prepare(ctx_id=0, det_size=(160, 160))
+                                root=insightface_root_path, providers=providers)
+        self.app_160.prepare(ctx_id=device_id, det_size=(160, 160))
 
         self.arcface_model = init_recognition_model('arcface', device='cuda')
 
@@ -229,6 +265,87 @@ class InfUFluxPipeline:
         if len(names) > 0:
             self.pipe.set_adapters(names, adapter_weights=scales)
 
+    def fuse_loras(self, adapter_names):
+        self.unfuse_loras()
+        self.fused_lora_layers = [
+            name for name, module in self.pipe.transformer.named_modules()
+            if isinstance(module, LoraLayer) and any(adapter_name in module.lora_A for adapter_name in adapter_names)
+        ]
+        self.pipe.fuse_lora(components=['transformer'], lora_scale=1.0, adapter_names=adapter_names)
+
+    def unfuse_loras(self):
+        if len(self.fused_lora_layers) == 0:
+            return
+        self.pipe.unfuse_lora(components=['transformer'])
+        # Unfusing is not exact in bf16, so the original weights of the fused layers are re-read from the checkpoint
+        self._reload_transformer_weights(self.fused_lora_layers)
+        self.fused_lora_layers = []
+
+    def _reload_transformer_weights(self, layer_names):
+        transformer_path = os.path.join(self.base_model_path, 'transformer')
+        if not os.path.isdir(transformer_path):
+            transformer_path = os.path.join(snapshot_download(self.base_model_path, allow_patterns=['transformer/*']), 'transformer')
+        keys = [f'{name}.weight' for name in layer_names]
+        index_path = os.path.join(transformer_path, SAFE_WEIGHTS_INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                weight_map = json.load(f)['weight_map']
+        else:
+            weight_map = dict.fromkeys(keys, SAFETENSORS_WEIGHTS_NAME)
+
+        # Only the needed tensors are read from the memory-mapped files, one at a time
+        modules = dict(self.pipe.transformer.named_modules())
+        for weight_file in sorted(set(weight_map[key] for key in keys)):
+            with safe_open(os.path.join(transformer_path, weight_file), framework='pt') as f:
+                for name, key in zip(layer_names, keys):
+                    if weight_map[key] == weight_file:
+                        modules[name].get_base_layer().weight.data.copy_(f.get_tensor(key))
+
+    def set_cpu_offload(self, cpu_offload):
+        # Toggle offloading in-place instead of reloading all weights
+        cpu_offload = get_cpu_offload_mode(cpu_offload)
+        if cpu_offload == self.cpu_offload:
+            return
+        if cpu_offload == 'layer-stream':
+            # Fail before any model is moved or hooked
+            LayerStreamOffloader.check_model(self.pipe.transformer)
+            LayerStreamOffloader.check_model(self.pipe.controlnet)
+        # Restore the original weights before they are moved, pinned or streamed
+        self.unfuse_loras()
+        for offloader in self.layer_stream_offloaders.values():
+            offloader.remove()
+        self.layer_stream_offloaders = {}
+        if cpu_offload == 'none':
+            self.pipe.to('cuda')
+        elif cpu_offload == 'model':
+            self.pipe.to('cpu')
+        else:
+            # Stream Transformer and InfuseNet blocks, keep the other models on GPU
+            self.pipe.text_encoder.to('cuda')
+            self.pipe.text_encoder_2.to('cuda')
+            self.pipe.vae.to('cuda')
+            self.layer_stream_offloaders = {
+                'transformer': LayerStreamOffloader(self.pipe.transformer),
+                'controlnet': LayerStreamOffloader(self.pipe.controlnet),
+            }
+        self.cpu_offload = cpu_offload
+
+    def switch_model_version(self, model_version, infusenet, image_proj_model):
+        # Swap in the InfuseNet and image proj model of another model version (see `load_infu_models`),
+        # the FLUX base model is shared by all model versions and is kept as is
+        if 'controlnet' in self.layer_stream_offloaders:
+            self.layer_stream_offloaders.pop('controlnet').remove()
+        self.infusenet = infusenet
+        self.pipe.controlnet = infusenet
+        # Free the previous InfuseNet, which may be kept in reference cycles, e.g., by NF4 weights or its offloader hooks
+        gc.collect()
+        if self.cpu_offload == 'none':
+            infusenet.to('cuda')
+        elif self.cpu_offload == 'layer-stream':
+            self.layer_stream_offloaders['controlnet'] = LayerStreamOffloader(infusenet)
+        self.image_proj_model = image_proj_model.to('cuda')
+        self.model_version = model_version
+
     def _detect_face(self, id_image_cv2):
         face_info = self.app_640.get(id_image_cv2)
         if len(face_info) > 0:
@@ -241,6 +358,21 @@ class InfUFluxPipeline:
         face_info = self.app_160.get(id_image_cv2)
         return face_info
 
+    def extract_id_embedding(self, id_image):
+        # ArcFace embedding of the largest face in the ID image, it does not depend on the model version
+        id_image_cv2 = cv2.cvtColor(np.array(id_image), cv2.COLOR_RGB2BGR)
+        face_info = self._detect_face(id_image_cv2)
+        if len(face_info) == 0:
+            raise ValueError('No face detected in the input ID image')
+        
+        face_info = sorted(face_info, key=lambda x:(x['bbox'][2]-x['bbox'][0])*(x['bbox'][3]-x['bbox'][1]))[-1] # only use the maximum face
+        landmark = face_info['kps']
+        self.arcface_model.to('cuda')
+        id_embed = extract_arcface_bgr_embedding(id_image_cv2, landmark, self.arcface_model)
+        self.arcface_model.cpu()
+        torch.cuda.empty_cache()
+        return id_embed
+
     def __call__(
         self,
         id_image: Image.Image,  # PIL.Image.Image (RGB)
@@ -254,31 +386,23 @@ class InfUFluxPipeline:
         infusenet_conditioning_scale = 1.0,
         infusenet_guidance_start = 0.0,
         infusenet_guidance_end = 1.0,
-        cpu_offload = False,
+        cpu_offload = None,  # None to follow `self.cpu_offload`
+        generator: Optional[torch.Generator] = None,  # created on GPU from `seed` if None
+        id_embedding: Optional[torch.Tensor] = None,  # from `extract_id_embedding`, skips face detection on `id_image`
     ):        
+        cpu_offload = self.cpu_offload if cpu_offload is None else get_cpu_offload_mode(cpu_offload)
+
         # Extract ID embeddings
         print('Preparing ID embeddings')
-        id_image_cv2 = cv2.cvtColor(np.array(id_image), cv2.COLOR_RGB2BGR)
-        face_info = self._detect_face(id_image_cv2)
-        if len(face_info) == 0:
-            raise ValueError('No face detected in the input ID image')
-        
-        face_info = sorted(face_info, key=lambda x:(x['bbox'][2]-x['bbox'][0])*(x['bbox'][3]-x['bbox'][1]))[-1] # only use the maximum face
-        landmark = face_info['kps']
-        self.arcface_model.to('cuda')
-        id_embed = extract_arcface_bgr_embedding(id_image_cv2, landmark, self.arcface_model)
-        self.arcface_model.cpu()
-        torch.cuda.empty_cache()
-        id_embed = id_embed.clone().unsqueeze(0).float().cuda()
-        id_embed = id_embed.reshape([1, -1, 512])
-        id_embed = id_embed.to(device='cuda', dtype=torch.bfloat16)
+        id_embed = self.extract_id_embedding(id_image) if id_embedding is None else id_embedding
+        # ArcFace runs in fp32, everything after it in bf16
+        id_embed = id_embed.reshape([1, -1, 512]).to(device='cuda', dtype=torch.bfloat16)
         self.image_proj_model.to('cuda', torch.bfloat16)
         with torch.no_grad():
             id_embed = self.image_proj_model(id_embed)
             bs_embed, seq_len, _ = id_embed.shape
             id_embed = id_embed.repeat(1, 1, 1)
             id_embed = id_embed.view(bs_embed * 1, seq_len, -1)
-            id_embed = id_embed.to(device='cuda', dtype=torch.bfloat16)
         self.image_proj_model.cpu()
         torch.cuda.empty_cache()
         
@@ -295,10 +419,13 @@ class InfUFluxPipeline:
         else:
             out_img = np.zeros([height, width, 3])
             control_image = Image.fromarray(out_img.astype(np.uint8))
+        control_image = to_pinned_tensor(control_image, size_multiple=self.pipe.vae_scale_factor)
 
         # Perform inference
         print('Generating image')
         seed_everything(seed)
+        if generator is None:
+            generator = torch.Generator(device='cuda').manual_seed(seed)
         image = self.pipe(
             prompt=prompt,
             controlnet_prompt_embeds=id_embed,
@@ -311,7 +438,8 @@ class InfUFluxPipeline:
             control_guidance_end=infusenet_guidance_end,
             height=height,
             width=width,
-            cpu_offload=cpu_offload,
+            generator=generator,
+            cpu_offload=cpu_offload == 'model',
         ).images[0]
 
         return image
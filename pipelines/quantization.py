@@ -0,0 +1,140 @@
+# Copyright (c) 2025 Bytedance Ltd. and/or its affiliates. All rights reserved.
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from optimum.quanto import freeze, qfloat8, qint4, qint8, quantize
+
+
+QUANTO_WEIGHTS = {
+    'int8': qint8,
+    'int4': qint4,
+    'fp8': qfloat8,
+}
+QUANTIZATION_CHOICES = ['bf16', 'nf4', *QUANTO_WEIGHTS, 'int8_blockwise']
+# Weight formats for the FLUX Transformer and T5, `bf16` for no quantization
+WEIGHT_QUANT_CHOICES = ['bf16', 'int8', 'int8_blockwise', 'nf4']
+# Weight formats for InfuseNet, `follow` to use the same as the FLUX Transformer and T5
+INFUSENET_QUANT_CHOICES = ['follow', *QUANTIZATION_CHOICES]
+
+
+class BlockwiseInt8Linear(nn.Linear):
+    """`nn.Linear` with int8 weights and one scale per `block_size` x `block_size` block of weights.
+
+    The weights are dequantized to the input dtype right before the matmul. This only saves memory: the dequantization
+    reads and writes more than a bf16 weight on every call, so the forward is slower than bf16 or quanto int8.
+
+    Args:
+        linear (nn.Linear): Layer to be quantized.
+        block_size (int): Size of the square weight blocks sharing a scale.
+    """
+
+    def __init__(self, linear, block_size=128):
+        super().__init__(linear.in_features, linear.out_features, bias=linear.bias is not None, device='meta')
+        self.block_size = block_size
+        out_blocks = -(-self.out_features // block_size)
+        in_blocks = -(-self.in_features // block_size)
+
+        weight = F.pad(linear.weight.data.float(), self._padding(out_blocks, in_blocks))
+        weight = weight.view(out_blocks, block_size, in_blocks, block_size)
+        scale = weight.abs().amax(dim=(1, 3), keepdim=True).clamp(min=1e-12) / 127
+        weight = torch.round(weight / scale).clamp(-127, 127).to(torch.int8)
+        weight = weight.view(out_blocks * block_size, in_blocks * block_size)[:self.out_features, :self.in_features]
+
+        self.weight = nn.Parameter(weight.contiguous(), requires_grad=False)
+        self.register_buffer('weight_scale', scale.view(out_blocks, in_blocks))
+        if linear.bias is not None:
+            self.bias = linear.bias
+
+    def _padding(self, out_blocks, in_blocks):
+        return (0, in_blocks * self.block_size - self.in_features, 0, out_blocks * self.block_size - self.out_features)
+
+    def dequantize(self, dtype):
+        out_blocks, in_blocks = self.weight_scale.shape
+        padding = self._padding(out_blocks, in_blocks)
+        weight = F.pad(self.weight, padding) if any(padding) else self.weight
+        weight = weight.view(out_blocks, self.block_size, in_blocks, self.block_size).to(dtype)
+        weight = weight * self.weight_scale.to(dtype)[:, None, :, None]
+        weight = weight.view(out_blocks * self.block_size, in_blocks * self.block_size)
+        return weight[:self.out_features, :self.in_features]
+
+    def forward(self, input):
+        return F.linear(input, self.dequantize(input.dtype), self.bias)
+
+
+def replace_linear_with_blockwise_int8(model, block_size=128):
+    """Replace all `nn.Linear` layers with `BlockwiseInt8Linear` layers."""
+    for name, child in model.named_children():
+        if isinstance(child, nn.Linear) and not isinstance(child, BlockwiseInt8Linear):
+            setattr(model, name, BlockwiseInt8Linear(child, block_size=block_size))
+        else:
+            replace_linear_with_blockwise_int8(child, block_size=block_size)
+
+
+def replace_linear_with_nf4(model, compute_dtype=torch.bfloat16, skip_modules=()):
+    """Replace all `nn.Linear` layers with bitsandbytes NF4 layers.
+
+    The weights are quantized when the model is moved to a CUDA device.
+    """
+    import bitsandbytes as bnb
+
+    for name, child in model.named_children():
+        if name in skip_modules:
+            continue
+        if isinstance(child, nn.Linear):
+            linear_4bit = bnb.nn.Linear4bit(
+                child.in_features,
+                child.out_features,
+                bias=child.bias is not None,
+                compute_dtype=compute_dtype,
+                quant_type='nf4',
+                device='meta',
+            )
+            linear_4bit.weight = bnb.nn.Params4bit(child.weight.data, requires_grad=False, quant_type='nf4', module=linear_4bit)
+            if child.bias is not None:
+                linear_4bit.bias = child.bias
+            setattr(model, name, linear_4bit)
+        else:
+            replace_linear_with_nf4(child, compute_dtype=compute_dtype, skip_modules=skip_modules)
+
+
+def resolve_infusenet_quant(infusenet_quant, weight_quant):
+    """Resolve the InfuseNet weight format, `None` or `follow` map to `weight_quant` and `none` to `bf16`."""
+    if infusenet_quant is None or infusenet_quant == 'follow':
+        return weight_quant
+    if infusenet_quant == 'none':
+        return 'bf16'
+    return infusenet_quant
+
+
+def quantize_model(model, quant):
+    """Quantize the weights of a model in-place.
+
+    Args:
+        model (nn.Module): Model to be quantized.
+        quant (str): Weight format: none (or bf16) | nf4 | int8 | int4 | fp8 | int8_blockwise.
+    """
+    if quant is None or quant in ('none', 'bf16'):
+        return
+    if quant == 'nf4':
+        # e.g., T5 casts the inputs of `wo` to its weight dtype, which is uint8 once packed to NF4
+        replace_linear_with_nf4(model, skip_modules=getattr(model, '_keep_in_fp32_modules', None) or ())
+    elif quant == 'int8_blockwise':
+        replace_linear_with_blockwise_int8(model)
+    elif quant in QUANTO_WEIGHTS:
+        quantize(model, weights=QUANTO_WEIGHTS[quant])
+        freeze(model)
+    else:
+        raise ValueError(f'Quantization {quant} not supported.')
@@ -18,7 +18,9 @@ import os
 import torch
 from PIL import Image
 
+from pipelines.offload import CPU_OFFLOAD_CHOICES
 from pipelines.pipeline_infu_flux import InfUFluxPipeline
+from pipelines.quantization import INFUSENET_QUANT_CHOICES, WEIGHT_QUANT_CHOICES
 
 
 def main():
@@ -43,7 +45,9 @@ def main():
     parser.add_argument('--enable_anti_blur_lora', action='store_true')
     # Memory reduction options
     parser.add_argument('--quantize_8bit', action='store_true')
-    parser.add_argument('--cpu_offload', action='store_true')
+    parser.add_argument('--weight_quant', default=None, choices=WEIGHT_QUANT_CHOICES, help="""Transformer and T5 weight format: bf16 | int8 | int8_blockwise | nf4, overrides --quantize_8bit""")
+    parser.add_argument('--cpu_offload', nargs='?', const='model', default='none', choices=CPU_OFFLOAD_CHOICES, help="""CPU offloading: none | model | layer-stream, model if given without a value""")
+    parser.add_argument('--infusenet_quant', default='follow', choices=INFUSENET_QUANT_CHOICES, help="""InfuseNet weight format: follow | bf16 | nf4 | int8 | int4 | fp8 | int8_blockwise, follow uses --weight_quant""")
     args = parser.parse_args()
 
     # Check arguments
@@ -63,7 +67,9 @@ def main():
         infu_flux_version=args.infu_flux_version,
         model_version=args.model_version,
         quantize_8bit=args.quantize_8bit,
+        weight_quant=args.weight_quant,
         cpu_offload=args.cpu_offload,
+        infusenet_quant=args.infusenet_quant,
     )
     # Load LoRAs (optional)
     lora_dir = os.path.join(args.model_dir, 'supports', 'optional_loras')